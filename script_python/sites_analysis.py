@@ -1,8 +1,14 @@
 import argparse
 import pandas
+import numpy as np
 from pathlib import Path
+from numba import njit
 import libsumo
 
+# number of rows read at a time from the associations files, so that the memory 
+# usage depends on the number of vehicles and sites instead of the file length
+CHUNK_SIZE = 1_000_000
+
 def number_users(input_path, output_path):
     """ Extracts the number of vehicles associated with every site at every simulation 
     step and then writes the results into a new csv file. Number '0' will be used 
@@ -24,19 +30,29 @@ def number_users(input_path, output_path):
     # correctly into the output file because otherwise they are written with an
     # ending '.0' like float numbers
     col_type = {'site_id': float}
-    df_in = pandas.read_csv(input_path, usecols=col_list, dtype=col_type)
-    df_in = df_in.fillna(0)
-    df_in['site_id'] = df_in['site_id'].astype(int)
-
-    df_out = df_in.value_counts().reset_index()
-    df_out = df_out.sort_values(by=['step', 'count'])
-    df_out.rename(columns={'step': 'timestamp', 'count': 'number_vehicles'}, 
-                      inplace=True)
+    chunks = pandas.read_csv(input_path, usecols=col_list, dtype=col_type, 
+                             chunksize=CHUNK_SIZE)
+
+    # counts the vehicles of every (step, site) pair one chunk at a time and 
+    # then sums the partial counts of the pairs split between two chunks
+    partial_counts = []
+    for df_in in chunks:
+        df_in['site_id'] = df_in['site_id'].fillna(0).astype(np.int32)
+        partial_counts.append(df_in.groupby(['step', 'site_id'], sort=False).size())
+    counts = (pandas.concat(partial_counts)
+              .groupby(level=['step', 'site_id'], sort=False).sum())
+
+    # the groups are not sorted by the groupby because the rows are sorted 
+    # only once here
+    df_out = counts.reset_index(name='number_vehicles')
+    df_out = df_out.rename(columns={'step': 'timestamp'})
+    df_out = df_out.sort_values(by=['timestamp', 'number_vehicles'])
     df_out.to_csv(output_path, mode='w', index=False)
 
 def route_time(input_path, output_path):
     """ Extracts for every vehicle the length of the path it followed in meters 
-    and the time it rimaned in the simulation in seconds.
+    and the time it rimaned in the simulation in seconds. Vehicles without an 
+    arrival time get a stay of 0 seconds.
 
     Parameters
     ----------
@@ -49,11 +65,14 @@ def route_time(input_path, output_path):
     # only load the necessary columns to reduce the memory usage
     col_list = ['vehicle_arrival', 'vehicle_depart', 'vehicle_id', 'vehicle_routeLength']
     col_type = {'vehicle_arrival': float, 'vehicle_depart': float, 'vehicle_id': str, 'vehicle_routeLength': float}
-    df_in = pandas.read_csv(input_path, usecols=col_list, dtype=col_type, sep=';')
-    df_in = df_in.fillna(0)
-    df_in['simulation_stay'] = df_in['vehicle_arrival'] - df_in['vehicle_depart']
-    df_out = df_in.drop(columns=['vehicle_arrival', 'vehicle_depart'])
-    df_out.to_csv(output_path, mode='w', index=False)
+    df = pandas.read_csv(input_path, usecols=col_list, dtype=col_type, sep=';', 
+                         engine='pyarrow', dtype_backend='pyarrow')
+
+    # the subtraction is NaN for the vehicles without an arrival time, only 
+    # the resulting column is filled instead of the whole dataframe
+    df['simulation_stay'] = (df['vehicle_arrival'] - df['vehicle_depart']).fillna(0)
+    df.drop(columns=['vehicle_arrival', 'vehicle_depart'], inplace=True)
+    df.to_csv(output_path, mode='w', index=False)
 
 def unique_sites(input_path, output_path):
     """ Extracts for every vehicle the number of unique sites that were associated 
@@ -69,12 +88,73 @@ def unique_sites(input_path, output_path):
 
     # only load the necessary columns to reduce the memory usage
     col_list = ['vehicle_id', 'site_id']
-    df_in = pandas.read_csv(input_path, usecols=col_list)
-    df_out = df_in.dropna()
-    df_out = df_out.drop_duplicates()
-    series_out = df_out['vehicle_id'].value_counts()
+
+    # categorical columns let the grouping work on integer codes instead of 
+    # the ids' strings
+    col_type = {'vehicle_id': 'category', 'site_id': 'category'}
+    df_in = pandas.read_csv(input_path, usecols=col_list, dtype=col_type, 
+                            engine='pyarrow')
+    series_out = (df_in.dropna(subset=['site_id'])
+                  .groupby('vehicle_id', sort=False, observed=True)['site_id']
+                  .nunique())
+    series_out = series_out.sort_values(ascending=False).rename('count')
     series_out.to_csv(output_path)
 
+def encode(values, codes):
+    """ Encodes the values of a column as integers that stay the same across 
+    all the chunks of a file.
+
+    Parameters
+    ----------
+    values : pandas.Series
+        The values of the column in the current chunk.
+    codes : dictionary
+        Dictionary that maps every value already seen to its code. New values 
+        are added with the next free code.
+
+    Returns
+    -------
+    numpy.ndarray
+        The code of every value, -1 for the missing values.
+    """
+
+    chunk_codes, uniques = pandas.factorize(values)
+
+    # the -1 appended at the end is the code picked by the missing values, 
+    # whose chunk code is -1 as well
+    mapping = [codes.setdefault(value, len(codes)) for value in uniques]
+    mapping = np.array(mapping + [-1], dtype=np.int64)
+    return mapping[chunk_codes]
+
+@njit(cache=True)
+def count_changes(veh_codes, site_codes, last_site, counts):
+    """ Counts the number of times the site associated with every vehicle 
+    changed, walking the rows in the order they were written. The state is 
+    kept in the arrays passed as arguments so that a file can be processed 
+    one chunk at a time.
+
+    Parameters
+    ----------
+    veh_codes : numpy.ndarray
+        Integer code of the vehicle of every row.
+    site_codes : numpy.ndarray
+        Integer code of the site of every row, -1 if the vehicle was not 
+        associated with any site.
+    last_site : numpy.ndarray
+        The code of the last site of every vehicle, indexed by the vehicle's 
+        code. It is updated in place.
+    counts : numpy.ndarray
+        The number of changes of every vehicle, indexed by the vehicle's code. 
+        It is updated in place.
+    """
+
+    for i in range(veh_codes.size):
+        veh = veh_codes[i]
+        site = site_codes[i]
+        if last_site[veh] != site:
+            counts[veh] += 1
+            last_site[veh] = site
+
 def num_changes(input_path, output_path):
     """ Extracts for every vehicle the number of times their association with a 
     cell site changed. A change is also counted if a vehicle goes from being
@@ -91,26 +171,37 @@ def num_changes(input_path, output_path):
 
     # only load the necessary columns to reduce the memory usage.
     col_list = ['vehicle_id', 'site_id']
-    df_in = pandas.read_csv(input_path, usecols=col_list)
 
-    # special site id '0' to identify vehicles that were not associated with any site.
-    df_in = df_in.fillna('0')
+    # the ids are read as strings because otherwise pandas guesses their type 
+    # separately for every chunk, and the same id could be parsed as a number 
+    # in one chunk and as a string in another one, getting two different codes
+    col_type = {'vehicle_id': str, 'site_id': str}
+    chunks = pandas.read_csv(input_path, usecols=col_list, dtype=col_type, 
+                             chunksize=CHUNK_SIZE)
 
-    # dictionary that will associate to every vehicle id a tuple with the current 
-    # site id and a counter with the number of site changes.
-    changes = {}
+    # the ids are encoded as integers in order of appearance, missing sites 
+    # (vehicles that were not associated with any site) get the code -1.
+    veh_index = {}
+    site_index = {}
 
-    # iterates over the rows of the csv and checks if the site associated with 
-    # a vehicle changed and updates its counter.
-    for row in df_in.itertuples():
-        vehicle_counter = changes.get(row[1], ('0', 0))
-        if vehicle_counter[0] != row[2]:
-            changes[row[1]] = (row[2], vehicle_counter[1]+1)
-    
-    # output dataframe creation
-    changes_counter = [{'vehicle_id': veh_id, 'count': association[1]} 
-                 for veh_id, association in changes.items()]
-    df = pandas.DataFrame(changes_counter)
+    # every vehicle starts without a site, so an initial association counts 
+    # as a change while an initial missing association doesn't
+    last_site = np.empty(0, np.int64)
+    counts = np.empty(0, np.int64)
+    for df_in in chunks:
+        veh_codes = encode(df_in['vehicle_id'], veh_index)
+        site_codes = encode(df_in['site_id'], site_index)
+
+        # makes room for the vehicles that appeared for the first time
+        new_vehicles = len(veh_index) - counts.size
+        last_site = np.concatenate((last_site, np.full(new_vehicles, -1, np.int64)))
+        counts = np.concatenate((counts, np.zeros(new_vehicles, np.int64)))
+        count_changes(veh_codes, site_codes, last_site, counts)
+
+    # output dataframe creation, vehicles that were never associated with a 
+    # site have no changes and are not written
+    df = pandas.DataFrame({'vehicle_id': list(veh_index), 'count': counts})
+    df = df[df['count'] > 0]
     df = df.sort_values(by=['count'], ascending=False)
     df.to_csv(output_path, mode='w', index=False)
 
@@ -132,28 +223,38 @@ def new_sites(association_path, edges_path, output_path):
         The path to the output file where the results will be written.
     """
 
-    df_ass = pandas.read_csv(association_path)
+    df_ass = pandas.read_csv(association_path, engine='pyarrow', dtype_backend='pyarrow')
 
     # extracts the vehicles that couldn't find a site that was near enough.
     # The site id is represented as Nan.
     df_nan = df_ass[df_ass['site_id'].isna()]
     df_nan = df_nan.drop_duplicates(subset=['vehicle_id'])
-    df_edges = pandas.read_csv(edges_path, sep=';')
+    df_edges = pandas.read_csv(edges_path, sep=';', engine='pyarrow', 
+                               dtype_backend='pyarrow')
+
+    # keeps only the positions at the steps in which the vehicles couldn't find 
+    # a site, so that the join works on a small fraction of the positions file
+    keys = pandas.MultiIndex.from_frame(df_nan[['step', 'vehicle_id']])
+    edges_keys = pandas.MultiIndex.from_frame(df_edges[['timestep_time', 'vehicle_id']])
+    df_edges = df_edges[edges_keys.isin(keys)]
 
     # merges with a join the sites associations with the position of the vehicle 
-    # at the correct step when it couldn't find a site.
-    df_merge = pandas.merge(df_nan, df_edges, left_on=['step', 'vehicle_id'], right_on=['timestep_time', 'vehicle_id'])
+    # at the correct step when it couldn't find a site. Both sides have only one 
+    # row for every vehicle and step.
+    df_merge = pandas.merge(df_nan, df_edges, left_on=['step', 'vehicle_id'], 
+                            right_on=['timestep_time', 'vehicle_id'], how='inner', 
+                            validate='1:1')
     
     # counts the number of times an edge is present in the csv to find the most 
     # used ones and then use that number to sort the rows
-    df_counts = df_merge['vehicle_edge'].value_counts().reset_index()
+    edge_counts = df_merge['vehicle_edge'].value_counts()
 
-    # merges the count of every edge with all the values of the previous dataframe
-    df_final = pandas.merge(df_merge, df_counts, on=['vehicle_edge'])
+    # maps the count of every edge on the rows of the previous dataframe
+    df_merge['count'] = df_merge['vehicle_edge'].map(edge_counts)
 
     # keeps only the column that will be written to the csv and also drops rows 
     # that are duplicates.
-    df_final = df_final.drop(labels=['step', 'site_id', 'timestep_time', 'vehicle_id'], axis=1)
+    df_final = df_merge.drop(labels=['step', 'site_id', 'timestep_time', 'vehicle_id'], axis=1)
     df_final = df_final.drop_duplicates()
     df_final = df_final.sort_values(by=['count'], ascending=False)
     df_final.to_csv(output_path, mode='w', index=False)
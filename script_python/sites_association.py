@@ -1,83 +1,177 @@
 import libsumo
 import os
+import csv
 import sys
-import random
 import pandas
 import argparse
+import numpy as np
 from pathlib import Path
+from scipy.spatial import cKDTree
 
-def new_cell_site(poi_pos, veh_coord, max_dist):
+# initial number of columns of the associations log, it doubles when it gets full
+LOG_CAPACITY = 1 << 20
+
+# number of columns of the log translated back to ids and written at a time, 
+# so that writing the log doesn't need memory proportional to its size
+WRITE_CHUNK = 1 << 16
+
+# initial number of vehicles' slots in the state arrays, they double when all 
+# the slots are in use
+VEH_SLOTS = 1 << 12
+
+# site codes with a special meaning in the state arrays: 'NO_SITE' for vehicles 
+# that have no site near enough and 'FREE_SLOT' for slots without a vehicle
+NO_SITE = -1
+FREE_SLOT = -2
+
+def new_cell_sites(tree, veh_xy, max_dist):
     """ 
-    Computes the new site for a vehicle.
+    Computes the new sites for a batch of vehicles.
 
-    The function iterates over every site and computes the distance to the vehicle.
-    The nearest one is chosen.
+    The nearest site of every vehicle is found with a single query on a k-d 
+    tree built on the sites' positions, so neither the sites nor the vehicles 
+    are iterated one by one.
 
     Parameters
     ----------
-    poi_pos : dictionary
-        A dictionary that maps a site id to a tuple with the coordinates of its 
-        position.
-    veh_coord : tuple
-        Coordinates with the current vehicle position.
+    tree : scipy.spatial.cKDTree
+        The k-d tree built on the sites' coordinates.
+    veh_xy : numpy.ndarray
+        Array of shape (M, 2) with the current positions of the vehicles.
     max_dist : float
-        The maximum allowed distance between the vehicle and the site.
+        The maximum allowed distance between a vehicle and its site.
 
     Returns
     -------
-    string
-        The new site's id or 'None' if no cell site is near enough.
+    numpy.ndarray
+        The new sites' codes in the same order as the vehicles, with 'NO_SITE' 
+        for the vehicles that have no cell site near enough.
     """
 
-    new_site = (None,float('inf'))
-
-    for id, poi_coord in poi_pos.items():
-        dist = libsumo.simulation.getDistance2D(poi_coord[0], poi_coord[1], 
-                                                veh_coord[0], veh_coord[1])
-        if dist < new_site[1]:
-            new_site = (id, dist)
+    # the upper bound of the query is exclusive, so it is moved to the next 
+    # float to also accept sites at exactly the maximum distance
+    dist, index = tree.query(veh_xy, workers=-1,
+                             distance_upper_bound=np.nextafter(max_dist, np.inf))
+    index[np.isinf(dist)] = NO_SITE
     
-    return new_site[0] if new_site[1] <= max_dist else None
+    return index
 
-def check_connection(poi_coord, veh_coord, dist):
-    """ Checks whether the distance between a vehicle and a site is greater 
-    than the parameter 'dist'.
+def check_connection(poi_xy, veh_xy, dist_sq):
+    """ Checks for a batch of vehicles whether the distance between every 
+    vehicle and its site is greater than the distance whose square is 'dist_sq'.
+
+    The squared distances are compared, so no square root is computed.
 
     Parameters
     ----------
-    poi_coord : tuple
-        The site's coordinates.
-    veh_coord : tuple
-        The vehicle's coordinates.
-    dist : float
-        The distance in meters between the vehicle and the tower to check.
+    poi_xy : numpy.ndarray
+        Array of shape (M, 2) with the coordinates of the vehicles' sites.
+    veh_xy : numpy.ndarray
+        Array of shape (M, 2) with the coordinates of the vehicles.
+    dist_sq : float
+        The square of the distance in meters between the vehicle and the tower 
+        to check.
 
     Returns
     -------
-    bool
-        True if distance is greater than the specified parameter, False otherwise.
+    numpy.ndarray
+        True for every vehicle whose distance is greater than the specified 
+        one, False otherwise.
     """
 
-    return libsumo.simulation.getDistance2D(poi_coord[0], poi_coord[1], 
-                                            veh_coord[0], veh_coord[1]) > dist
+    diff = poi_xy - veh_xy
+    return np.einsum('ij,ij->i', diff, diff) > dist_sq
 
-def write_positions(vehicles, step, file_path):
-    """ Writes on a file the current connections between vehicles and cell sites.
+def grow_slots(assigned_site, last_pos, veh_num):
+    """ Doubles the number of vehicles' slots of the state arrays. The new 
+    slots are marked as free.
 
     Parameters
     ----------
-    vehicles : dictionary
-        Dictionary that maps every vehicle's id to its site.
+    assigned_site : numpy.ndarray
+        The site's code of the vehicle in every slot.
+    last_pos : numpy.ndarray
+        Array of shape (slots, 2) with the last position of every vehicle.
+    veh_num : numpy.ndarray
+        The code in the log of the vehicle in every slot.
+
+    Returns
+    -------
+    tuple
+        The three bigger arrays, in the same order as the parameters.
+    """
+
+    slots = assigned_site.size
+    assigned_site = np.concatenate((assigned_site, 
+                                    np.full(slots, FREE_SLOT, np.int32)))
+    last_pos = np.concatenate((last_pos, np.zeros((slots, 2))))
+    veh_num = np.concatenate((veh_num, np.zeros(slots, np.int32)))
+    return assigned_site, last_pos, veh_num
+
+def log_positions(log, size, step, veh_codes, site_codes):
+    """ Stores in the log the current connections between vehicles and cell 
+    sites. The log is an int32 array with one column for every connection and 
+    the step, the vehicle's code and the site's code as rows.
+
+    Parameters
+    ----------
+    log : numpy.ndarray
+        The associations log of shape (3, capacity).
+    size : integer
+        The number of columns of the log already in use.
     step : integer
         The current step of the simulation.
-    file_name : string
-        The file path to the output file.
+    veh_codes : numpy.ndarray
+        The codes of the vehicles in the simulation.
+    site_codes : numpy.ndarray
+        The codes of the vehicles' sites.
+
+    Returns
+    -------
+    tuple
+        The log, which is a new bigger array if the old one was full, and the 
+        number of its columns in use.
     """
 
-    situation = [{'Step': step, 'Id_vehicle': veh_id, 'Id_site': cell_site} 
-                 for veh_id, cell_site in vehicles.items()]
-    df = pandas.DataFrame(situation)
-    df.to_csv(file_path, mode='a', index=False, header=False)
+    end = size + veh_codes.size
+    if end > log.shape[1]:
+        grown = np.empty((3, max(2 * log.shape[1], end)), dtype=np.int32)
+        grown[:, :size] = log[:, :size]
+        log = grown
+
+    log[0, size:end] = step
+    log[1, size:end] = veh_codes
+    log[2, size:end] = site_codes
+    return log, end
+
+def write_positions(writer, log, size, veh_ids, poi_ids):
+    """ Writes on a file the connections between vehicles and cell sites stored 
+    in the log, translating the codes back to the ids. The log is written in 
+    slices of 'WRITE_CHUNK' columns.
+
+    Parameters
+    ----------
+    writer : csv.writer
+        The csv writer of the output file.
+    log : numpy.ndarray
+        The associations log of shape (3, capacity).
+    size : integer
+        The number of columns of the log in use.
+    veh_ids : list
+        The vehicles' ids, indexed by their code.
+    poi_ids : numpy.ndarray
+        The sites' ids, indexed by their code.
+    """
+
+    veh_labels = np.array(veh_ids, dtype=object)
+
+    # the empty id appended at the end is the one picked by the code -1 of the 
+    # vehicles without a site
+    site_labels = np.append(poi_ids, '')
+    for start in range(0, size, WRITE_CHUNK):
+        steps, veh_codes, site_codes = log[:, start:min(start + WRITE_CHUNK, size)]
+        writer.writerows(zip(steps.tolist(), veh_labels[veh_codes], 
+                             site_labels[site_codes]))
     
 def main():
     """ Main function that computes the associations between vehicles and cell 
@@ -123,14 +217,25 @@ def main():
         sys.exit("Please declare environment variable 'SUMO_HOME'")
 
     from sumolib import checkBinary, net
-    poi_pos = {}
-    vehicles = {}
+    # every vehicle in the simulation occupies a slot of the state arrays, 
+    # the slots of the arrived vehicles are reused by the new ones
+    code_of = {}
+    free_codes = list(range(VEH_SLOTS - 1, -1, -1))
+    assigned_site = np.full(VEH_SLOTS, FREE_SLOT, np.int32)
+    last_pos = np.zeros((VEH_SLOTS, 2))
+    veh_num = np.zeros(VEH_SLOTS, np.int32)
+
+    # the vehicles' ids in order of departure, indexed by their code in the log
+    veh_ids = []
     sumoBinary = checkBinary('sumo')
     # checks the output file path and creates missing directories
     output_path = Path(args.output)
     output_path.parent.mkdir(exist_ok=True, parents=True)
-    df = pandas.DataFrame(list(), columns = ['step', 'vehicle_id', 'site_id'])
-    df.to_csv(args.output, mode='w', index=False)
+    # the associations are kept in memory during the simulation and written 
+    # at the end through a large buffer
+    out_f = open(args.output, 'w', buffering=1<<20, newline='')
+    out_f.write('step,vehicle_id,site_id\n')
+    writer = csv.writer(out_f, lineterminator='\n')
     libsumo.start([sumoBinary, "-c", args.sumo_cfg,])
     red = (255, 0, 0) # color assigned to the sites
 
@@ -139,61 +244,119 @@ def main():
             raise TypeError("You need to provide the sumo net file")
         sites = pandas.read_csv(args.input)
         net = net.readNet(args.sumo_net)
+        poi_ids = []
+        poi_xy = []
         for row in sites.itertuples():
             # the first value is the row index, so it is ignored
             x, y =  net.convertLonLat2XY(row[3], row[2])
             libsumo.poi.add(str(row[1]), x, y, red)
+            poi_ids.append(str(row[1]))
+            poi_xy.append((x, y))
     elif args.cell_sites:
         x_y_min, x_y_max = libsumo.simulation.getNetBoundary()
         x_max, y_max = int(x_y_max[0]), int(x_y_max[1])
         x_min, y_min = int(x_y_min[0]), int(x_y_min[1])
         csv_name = 'output_sites_pos.csv'
-        sites_pos = pandas.DataFrame(list(), columns = ['site_id', 'x', 'y'])
-        sites_pos.to_csv(csv_name, mode='w', index=False)
-        # adds sites in random positions
-        for i in range(args.cell_sites):
-            x = random.randint(x_min, x_max)
-            y = random.randint(y_min, y_max)
-            libsumo.poi.add(str(i), x, y, red)
-            site_pos = pandas.DataFrame([{'site_id': str(i), 'x': x, 'y': y}])
-            site_pos.to_csv(csv_name, mode='a', index=False, header=False)
+        # adds sites in random positions, all generated at once and written 
+        # to the sites file in one go
+        rng = np.random.default_rng()
+        xs = rng.integers(x_min, x_max, args.cell_sites, endpoint=True)
+        ys = rng.integers(y_min, y_max, args.cell_sites, endpoint=True)
+        ids = np.arange(args.cell_sites)
+        for i, x, y in zip(ids, xs, ys):
+            libsumo.poi.add(str(i), int(x), int(y), red)
+        poi_ids = ids.astype(str)
+        poi_xy = np.column_stack((xs, ys))
+        np.savetxt(csv_name, np.column_stack((ids, xs, ys)), fmt='%d', 
+                   delimiter=',', header='site_id,x,y', comments='')
     else:
         raise TypeError("You need to provide at least one argument between the "
                         "input sites file and the number of sites to generate")        
 
-    poi_pos = {poi_id:libsumo.poi.getPosition(poi_id) for poi_id in libsumo.poi.getIDList()}
-
-    for step in range(args.time+1):
-        check = True if step % args.step == 0 else False
-        libsumo.simulationStep()
-
-        # deletes arrived vehicles
-        for veh_id in libsumo.simulation.getArrivedIDList():
-            try:
-                del vehicles[veh_id]
-            except:
-                print("Error during the removal of the arrived vehicles")
-
-        # subscribes new vehicles to register their position
-        for veh_id in libsumo.simulation.getDepartedIDList():
-            libsumo.vehicle.subscribe(veh_id, [libsumo.constants.VAR_POSITION])
-        
-        # retrieves the vehicles' positions
-        for veh_id, subscriptions in libsumo.vehicle.getAllSubscriptionResults().items():
-            coordinates_veh = subscriptions[libsumo.constants.VAR_POSITION]
-            poi_id = vehicles.get(veh_id, None)
-
-            # assigns a new site to a vehicle only if it entered the simulation 
-            # in this step or the steps indicated by 'args.step' have passed and
-            # its distance from the current site is greater than the number indicated
-            # by the variable 'args.distance'
-            if not poi_id or (check and check_connection(poi_pos[poi_id], 
-                                                         coordinates_veh, args.distance)):
-                vehicles[veh_id] = new_cell_site(poi_pos, coordinates_veh, args.distance)
-
-        if check:
-            write_positions(vehicles, step, args.output)
-    libsumo.close()
+    # the sites never move and their positions are the ones just added, so 
+    # they are stored once in contiguous arrays and indexed with a k-d tree for 
+    # the nearest site searches. A site's code is its index in both arrays.
+    # The reshape keeps the shape (0, 2) when there are no sites, so that the 
+    # tree is empty and no vehicle gets a site.
+    poi_ids = np.asarray(poi_ids, dtype=str)
+    poi_xy = np.ascontiguousarray(poi_xy, dtype=np.float64).reshape(-1, 2)
+    tree = cKDTree(poi_xy)
+    log = np.empty((3, LOG_CAPACITY), dtype=np.int32)
+    log_size = 0
+    max_dist_sq = args.distance ** 2
+
+    # buffer reused at every step for the positions of the vehicles to check 
+    # or to assign, it has as many rows as there are vehicles' slots
+    veh_xy_buf = np.empty_like(last_pos)
+
+    try:
+        for step in range(args.time+1):
+            check = True if step % args.step == 0 else False
+            libsumo.simulationStep()
+
+            # deletes arrived vehicles and frees their slots
+            for veh_id in libsumo.simulation.getArrivedIDList():
+                code = code_of.pop(veh_id, None)
+                if code is not None:
+                    assigned_site[code] = FREE_SLOT
+                    free_codes.append(code)
+
+            # subscribes new vehicles to register their position and gives 
+            # them a slot and a code for the log
+            for veh_id in libsumo.simulation.getDepartedIDList():
+                libsumo.vehicle.subscribe(veh_id, [libsumo.constants.VAR_POSITION])
+                if not free_codes:
+                    slots = assigned_site.size
+                    assigned_site, last_pos, veh_num = grow_slots(assigned_site, 
+                                                                  last_pos, veh_num)
+                    free_codes.extend(range(2 * slots - 1, slots - 1, -1))
+                code = free_codes.pop()
+                code_of[veh_id] = code
+                assigned_site[code] = NO_SITE
+                veh_num[code] = len(veh_ids)
+                veh_ids.append(veh_id)
+            
+            if veh_xy_buf.shape[0] < last_pos.shape[0]:
+                veh_xy_buf = np.empty_like(last_pos)
+
+            # retrieves the vehicles' positions
+            results = libsumo.vehicle.getAllSubscriptionResults()
+            codes = np.fromiter((code_of[veh_id] for veh_id in results), 
+                                dtype=np.intp, count=len(results))
+            if codes.size:
+                last_pos[codes] = [subscriptions[libsumo.constants.VAR_POSITION] 
+                                   for subscriptions in results.values()]
+
+                # assigns a new site to a vehicle only if it entered the simulation 
+                # in this step or the steps indicated by 'args.step' have passed and
+                # its distance from the current site is greater than the number indicated
+                # by the variable 'args.distance'
+                cur_sites = assigned_site[codes]
+                need = cur_sites < 0
+                # the positions are gathered into the buffer, 'clip' avoids the 
+                # temporary copy numpy makes for 'out' with the default mode
+                if check:
+                    connected = ~need
+                    conn_codes = codes[connected]
+                    conn_xy = np.take(last_pos, conn_codes, axis=0, mode='clip', 
+                                      out=veh_xy_buf[:conn_codes.size])
+                    need[connected] = check_connection(poi_xy[cur_sites[connected]], 
+                                                       conn_xy, max_dist_sq)
+                need_codes = codes[need]
+                if need_codes.size:
+                    need_xy = np.take(last_pos, need_codes, axis=0, mode='clip', 
+                                      out=veh_xy_buf[:need_codes.size])
+                    assigned_site[need_codes] = new_cell_sites(tree, need_xy, 
+                                                               args.distance)
+
+            if check:
+                active = np.flatnonzero(assigned_site >= NO_SITE)
+                log, log_size = log_positions(log, log_size, step, veh_num[active], 
+                                              assigned_site[active])
+    finally:
+        libsumo.close()
+        write_positions(writer, log, log_size, veh_ids, poi_ids)
+        out_f.close()
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,6 @@
-import pandas
 import argparse
+import pyarrow.csv as pcsv
+import pyarrow.compute as pc
 from pathlib import Path
 
 def extraction(input_path, output_file, city_name):
@@ -18,21 +19,31 @@ def extraction(input_path, output_file, city_name):
 
     col_list = ['node_id', 'cell_lat', 'cell_long', 'site_name']
     
-    df = pandas.read_csv(input_path, sep=";", usecols=col_list)
+    # the file is read into contiguous arrow arrays and without pandas
+    table = pcsv.read_csv(input_path, 
+                          parse_options=pcsv.ParseOptions(delimiter=';'),
+                          convert_options=pcsv.ConvertOptions(include_columns=col_list))
 
-    # filters the dataframe to keep only the sites of the specified city
-    turin_cells = df[df['site_name'].str.contains(city_name, na=False)]
+    # filters the table to keep only the sites of the specified city, the rows 
+    # without a site name are dropped
+    mask = pc.match_substring(table['site_name'], city_name)
+    turin_cells = table.filter(mask)
 
-    # filters the cells to keep only one per site
-    cell_sites = turin_cells.drop_duplicates(subset=['node_id'])
+    # filters the cells to keep only the first one of every site. The grouping 
+    # is single threaded so that 'first' follows the order of the file.
+    cell_sites = turin_cells.group_by('node_id', use_threads=False).aggregate(
+        [('cell_lat', 'first'), ('cell_long', 'first'), ('site_name', 'first')])
 
     # eliminate every column that won't be needed for the simulation
-    cell_sites = cell_sites[['node_id', 'cell_lat', 'cell_long', 'site_name']]
+    cell_sites = cell_sites.select(['node_id', 'cell_lat_first', 'cell_long_first', 
+                                    'site_name_first'])
+    cell_sites = cell_sites.rename_columns(['node_id', 'site_lat', 'site_long', 
+                                            'site_name'])
 
-    cell_sites.rename(columns={'cell_lat': 'site_lat', 'cell_long': 'site_long'}, 
-                      inplace=True)
-
-    cell_sites.to_csv(output_file, mode='w',  index=False)
+    # arrow quotes every string value, but the header is written unquoted 
+    # like the column names of the input files
+    pcsv.write_csv(cell_sites, output_file, 
+                   write_options=pcsv.WriteOptions(quoting_header='none'))
 
 def main():
     """ Handles the command line arguments and calls the extraction function 